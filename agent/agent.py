@@ -1,12 +1,33 @@
-from flask import Flask, request, jsonify
-from flask_cors import CORS
+import asyncio
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Request
+from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, StreamingResponse
 from dotenv import load_dotenv, find_dotenv
 import os
-import requests as http_requests
+import orjson
+import httpx
+import redis
+import redis.asyncio as aioredis
+from redis.exceptions import WatchError
 from langchain_anthropic import ChatAnthropic
-from langchain_core.messages import HumanMessage, AIMessage, SystemMessage, ToolMessage
+from langchain_community.cache import InMemoryCache, RedisCache
+from langchain_core.caches import BaseCache
+from langchain_core.globals import set_llm_cache
+from langchain_core.messages import (
+    HumanMessage, AIMessage, SystemMessage, ToolMessage, messages_from_dict, messages_to_dict,
+    trim_messages
+)
+from langchain_core.messages.utils import count_tokens_approximately
 from langchain_core.tools import tool
 
+# Prefer RE2 (linear-time matching, no backtracking) for the command patterns.
+# Bound to its own name so only those patterns run on RE2.
+try:
+    import re2 as regex_engine
+except ImportError:
+    import re as regex_engine
+
 # Load .env from project root
 load_dotenv(find_dotenv())
 
@@ -31,17 +52,86 @@ if langfuse_enabled:
 else:
     lf_client = None
 
-app = Flask(__name__)
-CORS(app)
+# Shared async HTTP client for webhook callbacks, reusing keep-alive connections
+http_client = httpx.AsyncClient(
+    timeout=5,
+    limits=httpx.Limits(max_connections=128, max_keepalive_connections=32)
+)
+
+
+@asynccontextmanager
+async def lifespan(app):
+    yield
+    await http_client.aclose()
+    await store.aclose()
+    if langfuse_enabled:
+        # Export any traces still queued by the background sender
+        lf_client.shutdown()
+
+
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(CORSMiddleware, allow_origins=['*'], allow_methods=['*'], allow_headers=['*'])
+
+
+@app.exception_handler(orjson.JSONDecodeError)
+async def invalid_json(request: Request, exc: orjson.JSONDecodeError):
+    """Malformed request bodies are a client error, not a 500"""
+    return JSONResponse({'status': 'error', 'message': 'Invalid JSON body'}, status_code=400)
 
 # Web server URL for callbacks (optional)
 WEB_SERVER_URL = os.getenv(
     'WEB_SERVER_URL', 'http://web-server.real-time-agents.svc.cluster.local'
 )
 
+REDIS_URL = os.getenv('REDIS_URL', 'redis://redis:6379')
+
+# Cache LLM responses so identical prompts skip the Anthropic round-trip.
+# The cache key is the full serialized prompt (system message, history and
+# user message) plus the model parameters. It uses its own LRU-evicting Redis
+# so cached completions never push out sessions or chat history.
+LLM_CACHE = os.getenv('LLM_CACHE', 'redis')
+LLM_CACHE_REDIS_URL = os.getenv('LLM_CACHE_REDIS_URL', 'redis://redis-cache:6379')
+
+
+class FailOpenCache(BaseCache):
+    """Wrap an LLM cache so backend errors count as a miss instead of failing the call"""
+
+    def __init__(self, cache):
+        self.cache = cache
+
+    def lookup(self, prompt, llm_string):
+        try:
+            return self.cache.lookup(prompt, llm_string)
+        except Exception as e:
+            print(f"LLM cache lookup failed: {e}")
+            return None
+
+    def update(self, prompt, llm_string, return_val):
+        try:
+            self.cache.update(prompt, llm_string, return_val)
+        except Exception as e:
+            print(f"LLM cache update failed: {e}")
+
+    def clear(self, **kwargs):
+        try:
+            self.cache.clear(**kwargs)
+        except Exception as e:
+            print(f"LLM cache clear failed: {e}")
+
+
+if LLM_CACHE == 'redis':
+    # Short timeouts so an unreachable cache costs little before falling through
+    set_llm_cache(FailOpenCache(RedisCache(
+        redis.Redis.from_url(LLM_CACHE_REDIS_URL, socket_connect_timeout=0.5, socket_timeout=0.5),
+        ttl=int(os.getenv('LLM_CACHE_TTL', '3600'))
+    )))
+elif LLM_CACHE == 'memory':
+    set_llm_cache(InMemoryCache())
+
 # Initialize Claude LLM
+LLM_MODEL = "claude-sonnet-4-20250514"
 llm = ChatAnthropic(
-    model="claude-sonnet-4-20250514",
+    model=LLM_MODEL,
     api_key=os.getenv('ANTHROPIC_API_KEY'),
     max_tokens=1024
 )
@@ -62,50 +152,244 @@ def click_button(button_text: str) -> str:
 tools = [click_button]
 llm_with_tools = llm.bind_tools(tools)
 
-# Store conversations in memory (replace with Redis in prod)
-conversations = {}
+# Messages that may need a UI action. Only these are sent with the tool schema;
+# everything else streams from the plain LLM without the extra tokens or the
+# non-streaming tool round-trip.
+TOOL_HINT_RE = regex_engine.compile(r"(?i)\b(click|press|tap|button|send|submit)\b")
+
+# Unambiguous "send test event" commands are handled locally without any LLM
+# call; anything with extra wording falls through to llm_with_tools. Only a
+# fixed set of determiners may sit between the verb and "test event".
+#   Matches:      "send test event", "Please send a test event!",
+#                 "click the Send Test Event button", "press send test event"
+#   Falls through: "send no test event", "send another test event",
+#                 "press anything but the test event", "don't send a test event",
+#                 "send a test event and explain why", "send test events"
+TEST_EVENT_BUTTON = "Send Test Event"
+DIRECT_COMMAND_RE = regex_engine.compile(
+    r"(?i)^\s*(?:please\s+)?(?:click|press|send)\s+(?:the\s+|a\s+)?(?:send\s+)?test event(?:\s+button)?[\s.!]*$"
+)
 
+# Conversation history lives in Redis so any worker or pod can serve a session
+store = aioredis.Redis.from_url(REDIS_URL, decode_responses=True)
+HISTORY_TTL = int(os.getenv('HISTORY_TTL', '3600'))
 
-@app.route('/health', methods=['GET'])
-def health():
-    return jsonify({'status': 'ok', 'service': 'agent'})
+# History is trimmed to a token budget; trimmed turns are folded into a
+# rolling summary that is kept in the system prompt
+HISTORY_MAX_TOKENS = int(os.getenv('HISTORY_MAX_TOKENS', '2000'))
 
+# Keep references to fire-and-forget tasks so they aren't garbage collected
+background_tasks = set()
 
-@app.route('/chat', methods=['POST'])
-def chat():
-    """Main chat endpoint with Langfuse tracking"""
-    data = request.json
 
-    session_id = data.get('session_id', 'default')
-    message = data.get('message', '')
-    customer_id = data.get('customer_id', 1)
-    user_events = data.get('user_events', [])
+async def load_history(session_id):
+    """Return the session's recent messages and the summary of older ones"""
+    raw, summary = await store.mget(f"hist:{session_id}", f"summary:{session_id}")
+    return (messages_from_dict(orjson.loads(raw)) if raw else []), summary
 
-    # Format user events for context
-    events_context = "\n".join(
-        [
-            f"[{e.get('time', '')}] {e.get('event', '')}"
-            + (f": {e.get('button', '')}" if e.get('button') else "")
-            + (f": {e.get('error', '')}" if e.get('error') else "")
-            for e in user_events[-10:]
-        ]
-    ) if user_events else "No recent activity"
 
-    # Initialize conversation history
-    chat_history = conversations.setdefault(session_id, [])
+async def append_history(session_id, turn):
+    """Append a turn to the stored history, trimmed to the token budget.
 
-    # System message
-    system_message = SystemMessage(
-        content=f"""You are a helpful support assistant.
+    Runs as a WATCH/MULTI/EXEC transaction that retries if another request
+    for the same session wrote the history first, so concurrent turns are
+    never lost. Nothing is held across the LLM call itself.
+    """
+    key = f"hist:{session_id}"
+    async with store.pipeline(transaction=True) as pipe:
+        while True:
+            try:
+                await pipe.watch(key)
+                raw = await pipe.get(key)
+                chat_history = (messages_from_dict(orjson.loads(raw)) if raw else []) + turn
+                kept = trim_messages(
+                    chat_history,
+                    max_tokens=HISTORY_MAX_TOKENS,
+                    token_counter=count_tokens_approximately,
+                    strategy="last",
+                    start_on="human"
+                )
+                pipe.multi()
+                pipe.set(key, orjson.dumps(messages_to_dict(kept)), ex=HISTORY_TTL)
+                await pipe.execute()
+                break
+            except WatchError:
+                continue
+
+    dropped = chat_history[:len(chat_history) - len(kept)]
+    if dropped:
+        task = asyncio.create_task(summarize_history(session_id, dropped))
+        background_tasks.add(task)
+        task.add_done_callback(background_tasks.discard)
+
+
+async def summarize_history(session_id, dropped):
+    """Fold messages trimmed from the history into the session's summary.
+
+    Dropped segments are queued on a list and folded in by whichever task
+    holds the session's summary lock, so overlapping turns never overwrite
+    each other's contribution to the summary.
+    """
+    pending_key = f"summary_pending:{session_id}"
+    try:
+        await store.rpush(pending_key, orjson.dumps(messages_to_dict(dropped)))
+        await store.expire(pending_key, HISTORY_TTL)
+
+        # Re-check after releasing: a segment queued while we held the lock
+        # was left for us by a task that failed to acquire it
+        while await store.llen(pending_key):
+            lock = store.lock(f"summary_lock:{session_id}", timeout=120)
+            if not await lock.acquire(blocking=False):
+                return
+            try:
+                await fold_pending_summary(session_id, pending_key)
+            finally:
+                await lock.release()
+    except Exception as e:
+        print(f"Error summarizing history: {e}")
+
+
+async def fold_pending_summary(session_id, pending_key):
+    """Summarize all queued segments into summary:{id}; caller holds the lock"""
+    summary_key = f"summary:{session_id}"
+    while True:
+        segments = await store.lrange(pending_key, 0, -1)
+        if not segments:
+            return
+
+        dropped = [m for segment in segments for m in messages_from_dict(orjson.loads(segment))]
+        previous = await store.get(summary_key)
+        transcript = "\n".join(f"{m.type}: {m.content}" for m in dropped)
+        if previous:
+            transcript = f"Summary so far:\n{previous}\n\nNew messages:\n{transcript}"
+
+        response = await llm.ainvoke([
+            SystemMessage(content="Summarize this support conversation in a few sentences. "
+                                  "Keep any facts the assistant may need later."),
+            HumanMessage(content=transcript)
+        ])
+
+        # Store the summary and drop exactly the segments it covers
+        async with store.pipeline(transaction=True) as pipe:
+            pipe.set(summary_key, response.content, ex=HISTORY_TTL)
+            pipe.ltrim(pending_key, len(segments), -1)
+            await pipe.execute()
+
+
+# System prompts; only the customer ID and recent activity vary per request
+CHAT_SYSTEM_PROMPT = """You are a helpful support assistant.
+Keep responses concise and helpful.
+
+Current customer ID: {customer_id}
+
+User's recent activity:
+{events_context}"""
+
+STREAM_SYSTEM_PROMPT = """You are a helpful support assistant with the ability to perform actions on the user's webpage.
 Keep responses concise and helpful.
 
+You have access to a click_button tool. When the user asks you to send a test event, click a button, or perform any UI action, use the click_button tool with the appropriate button text.
+
+Available buttons on the page:
+- "Send Test Event" - sends a test event
+
 Current customer ID: {customer_id}
 
 User's recent activity:
 {events_context}"""
+
+SUMMARY_HEADER = "\n\nSummary of earlier conversation:\n"
+
+
+def format_event(e):
+    """Format one user event as a line of prompt context"""
+    line = f"[{e.get('time', '')}] {e.get('event', '')}"
+    button = e.get('button')
+    if button:
+        line += f": {button}"
+    error = e.get('error')
+    if error:
+        line += f": {error}"
+    return line
+
+
+BATCH_MAX_CONCURRENCY = int(os.getenv('BATCH_MAX_CONCURRENCY', '10'))
+# Each item is one paid completion, so cap the total per request as well
+MAX_BATCH_ITEMS = int(os.getenv('MAX_BATCH_ITEMS', '10'))
+
+
+def build_messages(message, customer_id, user_events, chat_history=(), summary=None,
+                   prompt=CHAT_SYSTEM_PROMPT):
+    """Build the prompt for a chat turn from a system prompt template"""
+    # Format user events for context
+    events_context = "\n".join(format_event(e) for e in user_events[-10:]) or "No recent activity"
+
+    # System message
+    system_message = SystemMessage(
+        content=prompt.format(customer_id=customer_id, events_context=events_context)
     )
+    if summary:
+        system_message.content += SUMMARY_HEADER + summary
 
-    messages = [system_message, *chat_history, HumanMessage(content=message)]
+    return [system_message, *chat_history, HumanMessage(content=message)]
+
+
+async def batch_chat(items):
+    """Run independent chat turns concurrently instead of one round-trip at a time"""
+    return await llm.abatch(
+        [
+            build_messages(
+                item.get('message', ''),
+                item.get('customer_id', 1),
+                item.get('user_events', [])
+            )
+            for item in items
+        ],
+        config={'max_concurrency': BATCH_MAX_CONCURRENCY}
+    )
+
+
+# Keep proxies from buffering the event stream
+SSE_HEADERS = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+
+SSE_PREFIX = b"data: "
+SSE_SUFFIX = b"\n\n"
+
+
+def content_text(content):
+    """Extract the text from message content (a string or a list of content blocks)"""
+    if isinstance(content, str):
+        return content
+    return "".join(
+        block.get('text', '') if isinstance(block, dict) else str(block)
+        for block in content
+    )
+
+
+def sse_event(payload):
+    """Encode a payload as an SSE frame, as bytes so no str encode is needed"""
+    return SSE_PREFIX + orjson.dumps(payload) + SSE_SUFFIX
+
+
+@app.get('/health')
+async def health():
+    return {'status': 'ok', 'service': 'agent'}
+
+
+@app.post('/chat')
+async def chat(request: Request):
+    """Main chat endpoint with Langfuse tracking"""
+    data = orjson.loads(await request.body())
+
+    session_id = data.get('session_id', 'default')
+    message = data.get('message', '')
+    customer_id = data.get('customer_id', 1)
+    user_events = data.get('user_events', [])
+
+    # Load conversation history
+    chat_history, summary = await load_history(session_id)
+
+    messages = build_messages(message, customer_id, user_events, chat_history, summary)
 
     try:
         if langfuse_enabled:
@@ -115,39 +399,75 @@ User's recent activity:
             ):
                 with lf_client.start_as_current_generation(
                     name="llm-response",
-                    model="claude-sonnet-4-20250514",
+                    model=LLM_MODEL,
                     input=message
                 ) as gen:
-                    response = llm.invoke(messages)
+                    response = await llm.ainvoke(messages)
                     response_text = response.content
                     gen.update(output=response_text)
         else:
-            response = llm.invoke(messages)
+            response = await llm.ainvoke(messages)
             response_text = response.content
 
         # Update conversation history
-        chat_history.extend([HumanMessage(content=message), AIMessage(content=response_text)])
-        conversations[session_id] = chat_history[-20:]
+        await append_history(session_id, [HumanMessage(content=message), AIMessage(content=response_text)])
+
+        return {'status': 'success', 'response': response_text, 'session_id': session_id}
+
+    except Exception as e:
+        print(f"Error in chat: {e}")
+        import traceback
+        traceback.print_exc()
+        return JSONResponse({'status': 'error', 'message': str(e)}, status_code=500)
+
+
+@app.post('/chat/batch')
+async def chat_batch(request: Request):
+    """Answer several independent messages in one request (no session history)"""
+    data = orjson.loads(await request.body())
+    items = data.get('items', []) if isinstance(data, dict) else None
 
+    if not isinstance(items, list) or not all(isinstance(item, dict) for item in items):
+        return JSONResponse(
+            {'status': 'error', 'message': "'items' must be a list of objects"}, status_code=400
+        )
+    if len(items) > MAX_BATCH_ITEMS:
+        return JSONResponse(
+            {'status': 'error', 'message': f"At most {MAX_BATCH_ITEMS} items per batch"}, status_code=400
+        )
+
+    try:
         if langfuse_enabled:
-            lf_client.flush()
+            messages = [item.get('message', '') for item in items]
+            with lf_client.start_as_current_span(
+                name="chat_batch",
+                input={"messages": messages}
+            ):
+                with lf_client.start_as_current_generation(
+                    name="llm-batch",
+                    model=LLM_MODEL,
+                    input=messages
+                ) as gen:
+                    responses = await batch_chat(items)
+                    response_texts = [r.content for r in responses]
+                    gen.update(output=response_texts)
+        else:
+            responses = await batch_chat(items)
+            response_texts = [r.content for r in responses]
 
-        return jsonify({'status': 'success', 'response': response_text, 'session_id': session_id})
+        return {'status': 'success', 'responses': response_texts}
 
     except Exception as e:
-        print(f"Error in chat: {e}")
+        print(f"Error in batch chat: {e}")
         import traceback
         traceback.print_exc()
-        return jsonify({'status': 'error', 'message': str(e)}), 500
+        return JSONResponse({'status': 'error', 'message': str(e)}, status_code=500)
 
 
-@app.route('/chat/stream', methods=['POST'])
-def chat_stream():
+@app.post('/chat/stream')
+async def chat_stream(request: Request):
     """Streaming chat endpoint using Server-Sent Events with tool support"""
-    from flask import Response
-    import json
-
-    data = request.json
+    data = orjson.loads(await request.body())
 
     session_id = data.get('session_id', 'default')
     message = data.get('message', '')
@@ -155,48 +475,31 @@ def chat_stream():
     user_events = data.get('user_events', [])
     webhook_url = data.get('webhook_url', '')
 
-    # Format user events for context
-    events_context = "\n".join(
-        [
-            f"[{e.get('time', '')}] {e.get('event', '')}"
-            + (f": {e.get('button', '')}" if e.get('button') else "")
-            + (f": {e.get('error', '')}" if e.get('error') else "")
-            for e in user_events[-10:]
-        ]
-    ) if user_events else "No recent activity"
-
-    # Initialize conversation history
-    chat_history = conversations.setdefault(session_id, [])
-
-    # System message
-    system_message = SystemMessage(
-        content=f"""You are a helpful support assistant with the ability to perform actions on the user's webpage.
-Keep responses concise and helpful.
-
-You have access to a click_button tool. When the user asks you to send a test event, click a button, or perform any UI action, use the click_button tool with the appropriate button text.
-
-Available buttons on the page:
-- "Send Test Event" - sends a test event
-
-Current customer ID: {customer_id}
+    # Load conversation history
+    chat_history, summary = await load_history(session_id)
 
-User's recent activity:
-{events_context}"""
+    use_tools = bool(TOOL_HINT_RE.search(message))
+    messages = build_messages(
+        message, customer_id, user_events, chat_history, summary,
+        prompt=STREAM_SYSTEM_PROMPT if use_tools else CHAT_SYSTEM_PROMPT
     )
 
-    messages = [system_message, *chat_history, HumanMessage(content=message)]
-
-    def generate():
+    async def generate():
         full_response = ""
         tool_calls_made = []
 
         try:
-            # First call with tools
-            response = llm_with_tools.invoke(messages)
+            if DIRECT_COMMAND_RE.match(message):
+                response = None
+                tool_calls = [{'name': 'click_button', 'args': {'button_text': TEST_EVENT_BUTTON}}]
+            else:
+                # First call with tools, only for messages that may need an action
+                response = await llm_with_tools.ainvoke(messages) if use_tools else None
+                tool_calls = response.tool_calls if response is not None else []
 
             # Check for tool calls
-            if response.tool_calls:
-                for tool_call in response.tool_calls:
+            if tool_calls:
+                for tool_call in tool_calls:
                     tool_name = tool_call['name']
                     tool_args = tool_call['args']
 
@@ -207,49 +510,48 @@ User's recent activity:
                         # Send action to frontend via webhook
                         if webhook_url:
                             try:
-                                http_requests.post(
+                                await http_client.post(
                                     webhook_url,
                                     json={
                                         'session_id': session_id,
                                         'action': 'click_button',
                                         'payload': {'button_text': button_text}
-                                    },
-                                    timeout=5
+                                    }
                                 )
                             except Exception as e:
                                 print(f"Webhook error: {e}")
 
                         # Send action event to frontend
-                        yield f"data: {json.dumps({'action': 'click_button', 'button_text': button_text})}\n\n"
+                        yield sse_event({'action': 'click_button', 'button_text': button_text})
 
                 # Generate follow-up response confirming the action
                 if tool_calls_made:
                     confirmation = f"Done! I've clicked the \"{tool_calls_made[0]}\" button for you."
-                    yield f"data: {json.dumps({'chunk': confirmation})}\n\n"
+                    yield sse_event({'chunk': confirmation})
                     full_response = confirmation
 
+            elif response is not None:
+                # Tools offered but not used - the answer is already complete
+                full_response = content_text(response.content)
+                if full_response:
+                    yield sse_event({'chunk': full_response})
+
             else:
-                # No tool calls - stream the text response
-                for chunk in llm_with_tools.stream(messages):
-                    if chunk.content:
-                        # Handle both string and list content types
-                        if isinstance(chunk.content, str):
-                            content = chunk.content
-                        elif isinstance(chunk.content, list) and len(chunk.content) > 0:
-                            # Extract text from content block objects
-                            block = chunk.content[0]
-                            content = block.get('text', '') if isinstance(block, dict) else str(block)
-                        else:
-                            content = ""
-                        if content:
-                            full_response += content
-                            yield f"data: {json.dumps({'chunk': content})}\n\n"
+                # No tools needed - stream the text response
+                async for chunk in llm.astream(messages):
+                    content = content_text(chunk.content)
+                    if content:
+                        full_response += content
+                        yield sse_event({'chunk': content})
 
             # Update conversation history
-            chat_history.extend([HumanMessage(content=message), AIMessage(content=full_response)])
-            conversations[session_id] = chat_history[-20:]
+            await append_history(session_id, [HumanMessage(content=message), AIMessage(content=full_response)])
 
-            # Log to Langfuse
+            # Send done event
+            yield sse_event({'done': True, 'session_id': session_id})
+
+            # Log to Langfuse after the client has its answer; spans are
+            # exported by Langfuse's background batch sender
             if langfuse_enabled:
                 with lf_client.start_as_current_span(
                     name="chat_stream",
@@ -257,32 +559,29 @@ User's recent activity:
                 ):
                     lf_client.start_generation(
                         name="llm-response",
-                        model="claude-sonnet-4-20250514",
+                        model=LLM_MODEL,
                         input=message,
                         output=full_response
-                    )
-                lf_client.flush()
-
-            # Send done event
-            yield f"data: {json.dumps({'done': True, 'session_id': session_id})}\n\n"
+                    ).end()
 
         except Exception as e:
             print(f"Error in stream: {e}")
             import traceback
             traceback.print_exc()
-            yield f"data: {json.dumps({'error': str(e)})}\n\n"
+            yield sse_event({'error': str(e)})
 
-    return Response(generate(), mimetype='text/event-stream')
+    return StreamingResponse(generate(), media_type='text/event-stream', headers=SSE_HEADERS)
 
 
-@app.route('/chat/reset', methods=['POST'])
-def reset_chat():
+@app.post('/chat/reset')
+async def reset_chat(request: Request):
     """Reset conversation history for a session"""
-    data = request.json
+    data = orjson.loads(await request.body())
     session_id = data.get('session_id', 'default')
-    conversations.pop(session_id, None)
-    return jsonify({'status': 'success', 'message': 'Conversation reset'})
+    await store.delete(f"hist:{session_id}", f"summary:{session_id}", f"summary_pending:{session_id}")
+    return {'status': 'success', 'message': 'Conversation reset'}
 
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5001, debug=False)
+    import uvicorn
+    uvicorn.run(app, host='0.0.0.0', port=5001)
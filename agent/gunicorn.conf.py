@@ -0,0 +1,16 @@
+import os
+
+bind = "0.0.0.0:5001"
+
+# Async workers: each process interleaves many in-flight LLM calls on one
+# event loop (uvloop via uvicorn[standard]). Each worker loads LangChain and
+# its own Redis/httpx pools, so keep the default count small.
+worker_class = "uvicorn_worker.UvicornWorker"
+workers = int(os.getenv('WEB_CONCURRENCY', '2'))
+
+# Worker heartbeat timeout; async workers keep beating during long LLM calls
+timeout = 120
+graceful_timeout = 30
+
+# No preload_app: the Langfuse client starts its exporter threads at import,
+# and threads do not survive the fork into workers
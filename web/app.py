@@ -1,12 +1,16 @@
 from flask import Flask, request, jsonify, send_from_directory, Response
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
-import json
+import orjson
 import os
-import uuid
-from datetime import datetime, timezone
+import secrets
+import types
+from datetime import datetime, timedelta, timezone
 import pandas as pd
+import redis
 from dotenv import load_dotenv, find_dotenv
 import requests as http_requests
+from requests.adapters import HTTPAdapter
 
 # Load .env from project root
 load_dotenv(find_dotenv())
@@ -16,6 +20,11 @@ AGENT_SERVICE_URL = os.getenv(
     'http://agent.real-time-agents.svc.cluster.local'
 )
 
+# Pooled keep-alive connections to the agent service
+http_session = http_requests.Session()
+http_session.mount('http://', HTTPAdapter(pool_connections=32, pool_maxsize=128))
+http_session.mount('https://', HTTPAdapter(pool_connections=32, pool_maxsize=128))
+
 # Optional Hopsworks
 fg = None
 try:
@@ -25,18 +34,56 @@ except ImportError:
     hopsworks_available = False
     print("Hopsworks not available - continuing without it")
 
-EVENT_TYPES = {
+# Read-only so it can be shared safely across request threads
+EVENT_TYPES = types.MappingProxyType({
     'page_view': {'category': 'navigation'},
     'button_clicked': {'category': 'interaction'},
+    'bot_clicked_button': {'category': 'interaction'},
+    'customer_switched': {'category': 'interaction'},
+    'chat_opened': {'category': 'chat'},
     'chat_message_sent': {'category': 'chat'},
+    'idle_tip_shown': {'category': 'chat'},
     'session_start': {'category': 'session'},
     'session_end': {'category': 'session'},
     'error': {'category': 'error'},
-}
+})
+
+# Sessions live in Redis so any worker or pod can serve them:
+#   sess:{id}          hash of session fields
+#   sess:{id}:pages    list of viewed pages
+#   sess:{id}:actions  hash of action_id -> JSON-encoded action
+store = redis.Redis.from_url(os.getenv('REDIS_URL', 'redis://redis:6379'), decode_responses=True)
+SESSION_TTL = int(os.getenv('SESSION_TTL', '3600'))
+MAX_PAGES_VIEWED = 50
+# Finished actions are dropped once they are this old
+ACTION_RETENTION = timedelta(minutes=10)
+
+
+def session_keys(session_id):
+    key = f"sess:{session_id}"
+    return key, f"{key}:pages", f"{key}:actions"
+
+
+def session_exists(session_id):
+    return bool(session_id) and bool(store.exists(f"sess:{session_id}"))
+
+
+def touch_session(pipe, session_id):
+    for key in session_keys(session_id):
+        pipe.expire(key, SESSION_TTL)
+
+class OrjsonProvider(DefaultJSONProvider):
+    """Flask JSON provider backed by orjson for request and response bodies"""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
 
-sessions = {}
 
 app = Flask(__name__, static_folder='static')
+app.json = OrjsonProvider(app)
 CORS(app, supports_credentials=True)
 
 @app.route('/')
@@ -50,16 +97,19 @@ def health():
 # -------------------------
 # Agent proxy
 # -------------------------
+# Behind the Istio gateway /agent/* is routed straight to the agent service
+# and never reaches these handlers; they only serve setups without the
+# gateway (e.g. running app.py locally).
 @app.route('/agent/<path:path>', methods=['GET', 'POST', 'PUT', 'DELETE'])
 def agent_proxy(path):
     url = f"{AGENT_SERVICE_URL}/{path}"
 
     try:
-        resp = http_requests.request(
+        resp = http_session.request(
             method=request.method,
             url=url,
             params=request.args if request.method == 'GET' else None,
-            json=request.json if request.method != 'GET' else None,
+            data=request.get_data() if request.method != 'GET' else None,
             headers={'Content-Type': 'application/json'},
             timeout=30
         )
@@ -73,28 +123,33 @@ def agent_proxy(path):
         return jsonify({'status': 'error', 'message': str(e)}), 503
 
 
+# Keep proxies (nginx, gunicorn) from buffering the event stream
+SSE_HEADERS = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+
+
 @app.route('/agent/chat/stream', methods=['POST'])
 def agent_stream_proxy():
     """Proxy streaming responses from agent"""
     url = f"{AGENT_SERVICE_URL}/chat/stream"
-    data = request.json  # Capture before generator
+    data = request.get_data()  # Capture before generator
 
     def generate():
         try:
-            with http_requests.post(
+            with http_session.post(
                 url,
-                json=data,
+                data=data,
                 headers={'Content-Type': 'application/json'},
                 stream=True,
                 timeout=60
             ) as resp:
-                for line in resp.iter_lines():
-                    if line:
-                        yield line.decode('utf-8') + '\n\n'
+                # Forward bytes as they arrive instead of waiting for full lines
+                for chunk in resp.iter_content(chunk_size=None):
+                    if chunk:
+                        yield chunk
         except http_requests.exceptions.RequestException as e:
-            yield f"data: {json.dumps({'error': str(e)})}\n\n"
+            yield b"data: " + orjson.dumps({'error': str(e)}) + b"\n\n"
 
-    return Response(generate(), mimetype='text/event-stream')
+    return Response(generate(), mimetype='text/event-stream', headers=SSE_HEADERS)
 
 # -------------------------
 # Session management
@@ -102,17 +157,19 @@ def agent_stream_proxy():
 @app.route('/session/start', methods=['POST'])
 def start_session():
     data = request.json or {}
-    session_id = str(uuid.uuid4())
+    session_id = secrets.token_hex(16)
+    now = datetime.now(timezone.utc).isoformat()
 
-    sessions[session_id] = {
+    key, _, _ = session_keys(session_id)
+    pipe = store.pipeline()
+    pipe.hset(key, mapping={
         'session_id': session_id,
-        'started_at': datetime.now(timezone.utc).isoformat(),
-        'last_activity': datetime.now(timezone.utc).isoformat(),
-        'events_count': 0,
-        'pages_viewed': [],
-        'actions': {},  # action_id -> command
-        'last_agent_action': None
-    }
+        'started_at': now,
+        'last_activity': now,
+        'events_count': 0
+    })
+    touch_session(pipe, session_id)
+    pipe.execute()
 
     return jsonify({'status': 'success', 'session_id': session_id})
 
@@ -120,10 +177,10 @@ def start_session():
 def end_session():
     session_id = request.json.get('session_id')
 
-    if session_id not in sessions:
+    if not session_exists(session_id):
         return jsonify({'status': 'error'}), 404
 
-    del sessions[session_id]
+    store.delete(*session_keys(session_id))
     return jsonify({'status': 'success'})
 
 # -------------------------
@@ -134,14 +191,23 @@ def events():
     data = request.json
     session_id = request.headers.get('X-Session-ID')
 
-    if session_id in sessions:
-        sessions[session_id]['events_count'] += 1
-        sessions[session_id]['last_activity'] = datetime.now(timezone.utc).isoformat()
+    if data.get('event') not in EVENT_TYPES:
+        return jsonify({'status': 'error', 'message': 'Unknown event type'}), 400
+
+    if session_exists(session_id):
+        key, pages_key, _ = session_keys(session_id)
+        pipe = store.pipeline()
+        pipe.hincrby(key, 'events_count', 1)
+        pipe.hset(key, 'last_activity', datetime.now(timezone.utc).isoformat())
 
         if data.get('event') == 'page_view':
             page = data.get('properties', {}).get('page')
             if page:
-                sessions[session_id]['pages_viewed'].append(page)
+                pipe.rpush(pages_key, page)
+                pipe.ltrim(pages_key, -MAX_PAGES_VIEWED, -1)
+
+        touch_session(pipe, session_id)
+        pipe.execute()
 
     return jsonify({'status': 'success'})
 
@@ -153,21 +219,26 @@ def agent_action_webhook():
     data = request.json or {}
     session_id = data.get('session_id')
 
-    if not session_id or session_id not in sessions:
+    if not session_exists(session_id):
         return jsonify({'status': 'error', 'message': 'Invalid session'}), 400
 
-    action_id = str(uuid.uuid4())
+    action_id = secrets.token_hex(16)
+    now = datetime.now(timezone.utc).isoformat()
 
     action = {
         'action_id': action_id,
         'type': data.get('action'),
         'payload': data.get('payload', {}),
         'status': 'pending',
-        'created_at': datetime.now(timezone.utc).isoformat()
+        'created_at': now
     }
 
-    sessions[session_id]['actions'][action_id] = action
-    sessions[session_id]['last_agent_action'] = datetime.now(timezone.utc).isoformat()
+    key, _, actions_key = session_keys(session_id)
+    pipe = store.pipeline()
+    pipe.hset(actions_key, action_id, orjson.dumps(action))
+    pipe.hset(key, 'last_agent_action', now)
+    touch_session(pipe, session_id)
+    pipe.execute()
 
     return jsonify({
         'status': 'received',
@@ -181,16 +252,26 @@ def agent_action_webhook():
 def get_pending_actions():
     session_id = request.headers.get('X-Session-ID') or request.args.get('session_id')
 
-    if not session_id or session_id not in sessions:
+    if not session_exists(session_id):
         return jsonify({'status': 'success', 'actions': []})
 
-    actions = sessions[session_id]['actions']
+    _, _, actions_key = session_keys(session_id)
+    actions = [orjson.loads(raw) for raw in store.hvals(actions_key)]
 
     pending = [
-        action for action in actions.values()
+        action for action in actions
         if action['status'] == 'pending'
     ]
 
+    # Prune finished actions past retention so the hash stays small
+    cutoff = (datetime.now(timezone.utc) - ACTION_RETENTION).isoformat()
+    expired = [
+        action['action_id'] for action in actions
+        if action['status'] != 'pending' and action.get('executed_at', '') < cutoff
+    ]
+    if expired:
+        store.hdel(actions_key, *expired)
+
     return jsonify({'status': 'success', 'actions': pending})
 
 # -------------------------
@@ -203,16 +284,19 @@ def action_ack():
     action_id = data.get('action_id')
     status = data.get('status', 'executed')
 
-    if session_id not in sessions:
+    if not session_exists(session_id):
         return jsonify({'status': 'error', 'message': 'Invalid session'}), 400
 
-    actions = sessions[session_id]['actions']
+    _, _, actions_key = session_keys(session_id)
+    raw = store.hget(actions_key, action_id) if action_id else None
 
-    if action_id not in actions:
+    if raw is None:
         return jsonify({'status': 'error', 'message': 'Unknown action'}), 404
 
-    actions[action_id]['status'] = status
-    actions[action_id]['executed_at'] = datetime.now(timezone.utc).isoformat()
+    action = orjson.loads(raw)
+    action['status'] = status
+    action['executed_at'] = datetime.now(timezone.utc).isoformat()
+    store.hset(actions_key, action_id, orjson.dumps(action))
 
     return jsonify({'status': 'ok'})
 
@@ -0,0 +1,13 @@
+import os
+
+bind = "0.0.0.0:5000"
+
+# Flask is sync, so use threaded workers; handlers mostly wait on Redis and
+# the agent service
+worker_class = "gthread"
+workers = int(os.getenv('WEB_CONCURRENCY', '2'))
+threads = int(os.getenv('GUNICORN_THREADS', '32'))
+timeout = 120
+
+# Load the app (pandas, hopsworks) once and share it copy-on-write
+preload_app = True